@@ -1,18 +1,38 @@
 # Copyright (c) 2024-2025 Theodore Sackos
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
-import difflib
+import asyncio
+import functools
+import io
+import json
+import mmap
 import os
+import signal
 import subprocess
 import textwrap
+import time
 
 from pathlib import Path
 from sys import argv
-from typing import Optional
+from typing import Optional, Union
 
 FAILED = 1
 PASSED = 0
 
+# Expected output files at least this large are memory-mapped rather than read into memory.
+MMAP_THRESHOLD_BYTES = 64 * 1024
+
+# Memory-mapped expected outputs are compared in slices of this size; small enough to stay in cache.
+COMPARE_CHUNK_BYTES = 64 * 1024
+
+# Mismatched outputs larger than this are written to disk for diffing, rather than printed inline.
+INLINE_REPORT_LIMIT_BYTES = 4 * 1024
+
+# The average runtime of each test case is kept in this file, inside the test suite directory, so that
+# the slowest test cases can be started first. Each new measurement is weighted by `RUNTIME_SMOOTHING`.
+RUNTIMES_FILE = ".runtimes.json"
+RUNTIME_SMOOTHING = 0.3
+
 class TestFiles:
     EVENT_SEED = "seed.lua"
     SPELL = "spell.lua"
@@ -20,51 +40,124 @@ class TestFiles:
     EXPECTED_STDERR = "stderr.assert"
     EXPECTED_EXIT_CODE = "exitcode.assert"
 
-def try_decode_utf8(std_x: bytes) -> str:
+def try_decode_utf8(std_x: bytes, out: io.StringIO) -> Optional[str]:
+    """
+    Decodes output for reporting. Returns None, after reporting the raw bytes, when the output is not
+    valid UTF-8; the caller should treat that as a failed test case.
+    """
     try:
         return std_x.decode("utf-8")
     except UnicodeDecodeError:
-        print("FAIL: Unable to decode test run output:")
-        print(str(std_x))
-        exit(1)
+        print("FAIL: Unable to decode test run output:", file=out)
+        print(str(std_x), file=out)
+        return None
 
-def assert_results_mach_expected(expected: str, actual_bytes: bytes) -> int:
-    actual = try_decode_utf8(actual_bytes)
-
-    diff = [l for l in difflib.unified_diff(expected, actual)]
-    if len(diff) != 0:
-        print("FAIL: Output does not match expected")
-        # I'm not finding this output particularly useful.. removing it for now.
-        # print("diff")
-        # print("".join(diff))
-        # print()
-        print("Expected:")
-        print(textwrap.indent(expected, ' > | '))
-        print("Actual:")
-        print(textwrap.indent(actual, ' ? | '))
-        print()
-        return FAILED
-    else:
+def read_expected(assert_file: Path) -> Union[bytes, mmap.mmap]:
+    """
+    Loads the contents of an expected output file. Large golden outputs are memory-mapped, which
+    avoids copying the whole file into a buffer and lets repeated runs be served from the page cache.
+    """
+    with open(assert_file, "rb") as f:
+        if os.fstat(f.fileno()).st_size < MMAP_THRESHOLD_BYTES:
+            return f.read()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def outputs_match(expected: Union[bytes, mmap.mmap], actual_bytes: bytes) -> bool:
+    # Outputs of different lengths can never match; checking first avoids touching a mapped file at all.
+    if len(expected) != len(actual_bytes):
+        return False
+    if isinstance(expected, mmap.mmap):
+        # mmap objects compare by identity, and comparing through a memoryview unpacks it item by item.
+        # Comparing slices as bytes uses memcmp instead, and stops at the first chunk that differs.
+        for start in range(0, len(actual_bytes), COMPARE_CHUNK_BYTES):
+            end = start + COMPARE_CHUNK_BYTES
+            if expected[start:end] != actual_bytes[start:end]:
+                return False
+        return True
+    return expected == actual_bytes
+
+def assert_results_mach_expected(assert_file: Path, expected_bytes: Union[bytes, mmap.mmap], actual_bytes: bytes, out: io.StringIO) -> int:
+    # Any actual output saved by an earlier failure is removed unless it is replaced below, so that an
+    # out of date file isn't mistaken for a current failure.
+    actual_file = assert_file.with_suffix(".actual")
+    if outputs_match(expected_bytes, actual_bytes):
+        actual_file.unlink(missing_ok=True)
         return PASSED
 
-def try_run_process(command: list, expected_exit_code: Optional[int]):
+    if max(len(expected_bytes), len(actual_bytes)) > INLINE_REPORT_LIMIT_BYTES:
+        # Too much to usefully read in the terminal; save the actual output next to the expected output instead.
+        actual_file.write_bytes(actual_bytes)
+        print("FAIL: Output does not match expected", file=out)
+        print(f"Expected: {assert_file}", file=out)
+        print(f"Actual:   {actual_file}", file=out)
+        print(f"    diff -u '{assert_file}' '{actual_file}'", file=out)
+        print(file=out)
+        return FAILED
+
+    actual_file.unlink(missing_ok=True)
+
+    # Only decode the outputs once they are known to differ, to produce a human-readable report.
+    expected = try_decode_utf8(bytes(expected_bytes), out)
+    actual = try_decode_utf8(actual_bytes, out)
+    if expected == None or actual == None:
+        return FAILED
+    print("FAIL: Output does not match expected", file=out)
+    print("Expected:", file=out)
+    print(textwrap.indent(expected, ' > | '), file=out)
+    print("Actual:", file=out)
+    print(textwrap.indent(actual, ' ? | '), file=out)
+    print(file=out)
+    return FAILED
+
+async def try_run_process(command: list, expected_exit_code: Optional[int], out: io.StringIO):
     expected_exit_code = expected_exit_code if expected_exit_code != None else 0
-    result = subprocess.run(command, capture_output=True)
+    # Every test case gets a fresh sanctum process rather than sharing a long-lived one in some batch
+    # mode: the process' own stdout, stderr and exit code are what is under test. Lua's `print()` and
+    # `std.debug.print` write straight to the inherited file descriptors, and errors end the process
+    # with `std.process.exit`, so none of them could be framed per test case inside a shared process.
+    # The program is started in its own session so that, if it is a wrapper which spawns children of
+    # its own, the whole process group can be killed together.
+    process = await asyncio.create_subprocess_exec(*command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    try:
+        (stdout, stderr) = await process.communicate()
+    except asyncio.CancelledError:
+        # Don't leave the program running when the test run is stopped early. The pipes are drained
+        # while waiting, since a process blocked writing to a full pipe may never exit.
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.communicate()
+        raise
+    result = subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
     if result.returncode != expected_exit_code:
-        print(f"FAIL: Exited with non-zero exit code {result.returncode}")
-        print("stdout:")
-        print(textwrap.indent(result.stdout.decode("utf-8"), '  '))
-        print("stderr:")
-        print(textwrap.indent(result.stderr.decode("utf-8"), '  '))
+        print(f"FAIL: Exited with non-zero exit code {result.returncode}", file=out)
+        print("stdout:", file=out)
+        print(textwrap.indent(try_decode_utf8(result.stdout, out) or "", '  '), file=out)
+        print("stderr:", file=out)
+        print(textwrap.indent(try_decode_utf8(result.stderr, out) or "", '  '), file=out)
         return (FAILED, result)
     else:
         return (PASSED, result)
 
-def _assert_outputs(test_dir_path, result):
+def _load_expected_outputs(test_dir_path):
+    """
+    Attempts to load the `stdout.assert` and `stderr.assert` files for the given test case. This is
+    run on a worker thread while the test case itself is running, so that the expected outputs are
+    already in memory by the time the program exits.
+    """
+    expected_outputs = {}
+    for assert_file_name in [TestFiles.EXPECTED_STDOUT, TestFiles.EXPECTED_STDERR]:
+        assert_file = test_dir_path / assert_file_name
+        if assert_file.is_file():
+            expected_outputs[assert_file_name] = read_expected(assert_file)
+    return expected_outputs
+
+def _assert_outputs(test_dir_path, result, expected_outputs, out):
     """
-    Attempts to load the `stdout.assert` and `stderr.assert` files for the given test case,
-    and compares them against the actual output from the program. If the expected output
-    does not match the actual output, the program is halted with an error: a test case failed.
+    Compares the expected outputs loaded by `_load_expected_outputs` for the given test case against
+    the actual output from the program. If the expected output does not match the actual output, the
+    program is halted with an error: a test case failed.
     """
     outcome = 0
     assertion_files = [
@@ -72,14 +165,14 @@ def _assert_outputs(test_dir_path, result):
         (TestFiles.EXPECTED_STDERR, result.stderr),
     ]
     for (assert_file_name, actual_bytes) in assertion_files:
-        assert_file = t / assert_file_name
-        if assert_file.is_file():
-            expected = assert_file.read_text()
-            if PASSED != assert_results_mach_expected(expected, actual_bytes):
+        if assert_file_name in expected_outputs:
+            assert_file = test_dir_path / assert_file_name
+            expected_bytes = expected_outputs[assert_file_name]
+            if PASSED != assert_results_mach_expected(assert_file, expected_bytes, actual_bytes, out):
                 outcome = FAILED
     return outcome
 
-def _freeze_outputs(test_dir_path, result):
+def _freeze_outputs(test_dir_path, result, _, out):
     """
     As breaking changes and refactorings are introduced to sanctum, it's common to find that
     the new actual output does not match the saved expected output files. In such a case, after
@@ -91,27 +184,188 @@ def _freeze_outputs(test_dir_path, result):
         (TestFiles.EXPECTED_STDERR, result.stderr),
     ]
     for (assert_file_name, actual_bytes) in assertion_files:
-        actual = try_decode_utf8(actual_bytes)
-        assert_file = t / assert_file_name
-        assert_file.write_text(actual)
+        assert_file = test_dir_path / assert_file_name
+        assert_file.write_bytes(actual_bytes)
+        assert_file.with_suffix(".actual").unlink(missing_ok=True)
     return PASSED
 
 # A mapping from the command line 'action' argument to information about how to run the action.
-# The action tuple contains a function to execute with the output from running the executable as a subprocess;
-# as well as a boolean indicating whether the action should be run on failure (True) or if the action
-# should be skipped when the subprocess fails with a non-zero exit code (False)
+# The action tuple contains an optional function to run on a worker thread while the executable is running,
+# whose result is passed on to the next function; a function to execute with the output from running the
+# executable as a subprocess; as well as a boolean indicating whether the action should be run on failure (True)
+# or if the action should be skipped when the subprocess fails with a non-zero exit code (False)
 TEST_ACTIONS = {
-    "--test": (_assert_outputs, False),
-    "--freeze": (_freeze_outputs, True),
+    "--test": (_load_expected_outputs, _assert_outputs, False),
+    "--freeze": (None, _freeze_outputs, True),
 }
 
+# Optional flags which may follow the action argument.
+TEST_FLAGS = ["--fail-fast"]
+
+def find_test_dirs(directory: str):
+    """
+    Recursively yields every directory containing a spell, starting at `directory`, along with the set
+    of file names in it. Uses a single `os.scandir` per directory rather than `os.walk`, which builds
+    lists of names and stats entries that the spell check does not need. Symlinked directories are not
+    followed.
+    """
+    with os.scandir(directory) as it:
+        entries = list(it)
+    names = {e.name for e in entries}
+    if TestFiles.SPELL in names:
+        yield (Path(directory), names)
+    for e in entries:
+        if e.is_dir(follow_symlinks=False):
+            yield from find_test_dirs(e.path)
+
+def discover(test_suite_dir: Path, exe: str):
+    """
+    Yields each test case found under the test suite directory; a test case is any directory containing
+    a spell. Each test case is a tuple of the test case directory, the command line used to run it and
+    its expected exit code (or None), so that running the test case needs no further path handling.
+    """
+    for (t, names) in find_test_dirs(str(test_suite_dir)):
+        event_seed = t / TestFiles.EVENT_SEED
+        spell = t / TestFiles.SPELL
+        # The directory listing from discovery is reused, rather than probing for the file again.
+        expected_exit_code = None
+        if TestFiles.EXPECTED_EXIT_CODE in names:
+            expected_exit_code = int((t / TestFiles.EXPECTED_EXIT_CODE).read_text().strip())
+        command = [exe, "cast", str(spell.resolve()), "--seed", str(event_seed.resolve())]
+        yield (t, command, expected_exit_code)
+
+def load_runtimes(test_suite_dir: Path) -> dict:
+    """
+    Loads the recorded runtimes of the test suite. They only affect the order that test cases are run
+    in, so a missing or unreadable file, or any entry which is not a number, is ignored.
+    """
+    try:
+        runtimes = json.loads((test_suite_dir / RUNTIMES_FILE).read_bytes())
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(runtimes, dict):
+        return {}
+    return {key: runtime for (key, runtime) in runtimes.items() if isinstance(runtime, (int, float)) and not isinstance(runtime, bool)}
+
+def save_runtimes(test_suite_dir: Path, runtimes: dict, tests: list, durations: dict):
+    """
+    Folds this run's measured durations into the recorded runtimes and saves them. Only the test cases
+    discovered in this run are kept, so renamed or deleted test cases are forgotten; those which were
+    discovered but not run (e.g. with `--fail-fast`) keep their previous runtime. Failing to save the
+    runtimes is reported as a warning only.
+    """
+    updated = {}
+    for (t, _, _) in tests:
+        key = str(t.relative_to(test_suite_dir))
+        previous = runtimes.get(key)
+        duration = durations.get(t)
+        if duration == None:
+            if previous != None:
+                updated[key] = previous
+        else:
+            updated[key] = duration if previous == None else previous + RUNTIME_SMOOTHING * (duration - previous)
+    runtimes_file = test_suite_dir / RUNTIMES_FILE
+    try:
+        runtimes_file.write_text(json.dumps(updated, indent=4, sort_keys=True))
+    except OSError as e:
+        # Only the order of future test runs depends on this file, so it must not fail the test run.
+        print(f"WARNING: Unable to save test case runtimes to '{runtimes_file}': {e}")
+
+def longest_first(test_suite_dir: Path, runtimes: dict):
+    """
+    Returns a sort key which orders test cases from the longest to the shortest average runtime, so
+    that a slow test case is never the last one left running (longest processing time first). Test
+    cases without a recorded runtime go first, largest spell first, since nothing is known about them.
+    """
+    def key(test_case):
+        t = test_case[0]
+        runtime = runtimes.get(str(t.relative_to(test_suite_dir)))
+        if runtime == None:
+            return (0, -(t / TestFiles.SPELL).stat().st_size)
+        return (1, -runtime)
+    return key
+
+async def run_one(test_case: tuple, action_name: str, action: tuple):
+    """
+    Runs a single test case and applies the requested action to its output. Test cases are run
+    concurrently, so anything the test case wants to report is collected and returned to be printed
+    in one piece, rather than interleaved with other test cases. Returns a tuple of the test case
+    directory, the number of failures (0 or 1) and the report text.
+    """
+    (t, command, expected_exit_code) = test_case
+    out = io.StringIO()
+    print(f"Running '{action_name}' on test case '{t}'", file=out)
+
+    (before_run_action, after_run_action, run_on_failure) = action
+    prepared = None
+    if before_run_action != None:
+        prepared = asyncio.get_running_loop().run_in_executor(None, before_run_action, t)
+    (run_outcome, result) = await try_run_process(command, expected_exit_code, out)
+    if prepared != None:
+        prepared = await prepared
+
+    if run_outcome == PASSED or run_on_failure:
+        failures = after_run_action(t, result, prepared, out)
+    else:
+        failures = FAILED
+        # No outputs were compared, so any actual outputs saved by an earlier failure are out of date.
+        for assert_file_name in [TestFiles.EXPECTED_STDOUT, TestFiles.EXPECTED_STDERR]:
+            (t / assert_file_name).with_suffix(".actual").unlink(missing_ok=True)
+    return (t, failures, out.getvalue())
+
+async def run_test_suite(tests, run, max_workers: int, fail_fast: bool):
+    """
+    Runs every test case with `run`, with at most `max_workers` of them in flight at once, printing
+    each report as its test case completes. With `fail_fast`, the first failure stops any further test
+    cases from starting and cancels those still running. Returns a tuple of the number of test cases
+    attempted and failed, and the runtime in seconds of each test case which completed.
+    """
+    attempts = 0
+    failures = 0
+    durations = {}
+    stopping = False
+    limit = asyncio.Semaphore(max_workers)
+
+    async def run_limited(test_case):
+        nonlocal attempts, failures, stopping
+        start = time.perf_counter()
+        try:
+            (t, outcome, report) = await run(test_case)
+        finally:
+            limit.release()
+        durations[t] = time.perf_counter() - start
+        attempts += 1
+        failures += outcome
+        print(report, end="")
+        if outcome != PASSED and fail_fast:
+            stopping = True
+            for task in tasks:
+                if task is not asyncio.current_task():
+                    task.cancel()
+
+    # The semaphore is acquired before each test case is started (rather than inside the task) so that
+    # no task is created until there is a free worker for it, and with `fail_fast` no further test cases
+    # are started once stopping.
+    tasks = []
+    for test_case in tests:
+        await limit.acquire()
+        if stopping:
+            break
+        tasks.append(asyncio.create_task(run_limited(test_case)))
+
+    # Cancelled test cases are expected when failing fast; anything else that went wrong is re-raised.
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            raise result
+    return (attempts, failures, durations)
+
 if __name__ == "__main__":
-    if len(argv) != 4:
+    if len(argv) not in (4, 5):
         file_name = Path(__file__).name
-        print(f"Invalid number of arguments.\n    Usage: `python {file_name} <path_to_executable_to_test> <path_to_test_suite_directory> [--test|--freeze]`")
+        print(f"Invalid number of arguments.\n    Usage: `python {file_name} <path_to_executable_to_test> <path_to_test_suite_directory> [--test|--freeze] [--fail-fast]`")
         exit(1)
 
-    [_, exe, test_suite_dir, action_arg] = argv
+    [_, exe, test_suite_dir, action_arg, *flags] = argv
     if not os.access(exe, os.X_OK):
         print(f"Unable to run program, '{argv[1]}' is not executable.")
         exit(1)
@@ -121,26 +375,29 @@ if __name__ == "__main__":
         print(f"Invalid test suite: '{argv[2]}', expected a path to a directory.")
         exit(1)
 
-    attempts = 0
-    failures = 0
-
-    tests = [Path(directory[0]) for directory in os.walk(str(test_suite_dir.resolve())) if TestFiles.SPELL in directory[2]]
-    for t in tests:
-        attempts += 1
-        print(f"Running '{action_arg.replace('-', '')}' on test case '{t}'")
-        event_seed = t / TestFiles.EVENT_SEED
-        spell = t / TestFiles.SPELL
-        exit_code = t / TestFiles.EXPECTED_EXIT_CODE
-        expected_exit_code = int(exit_code.read_text().strip()) if exit_code.is_file() else None
-        command = [exe, "cast", str(spell.resolve()), "--seed", str(event_seed.resolve())]
+    action = TEST_ACTIONS.get(action_arg)
+    if action == None:
+        print(f"Invalid action: '{argv[3]}', expected one of [{'|'.join(TEST_ACTIONS)}].")
+        exit(1)
 
-        (after_run_action, run_on_failure) = TEST_ACTIONS[action_arg]
-        (run_outcome, result) = try_run_process(command, expected_exit_code)
+    for flag in flags:
+        if flag not in TEST_FLAGS:
+            print(f"Invalid flag: '{flag}', expected one of [{'|'.join(TEST_FLAGS)}].")
+            exit(1)
+    fail_fast = "--fail-fast" in flags
 
-        if run_outcome == PASSED or run_on_failure:
-            failures += after_run_action(t, result)
-        else:
-            failures += FAILED
+    # Each test case is independent, so they are run concurrently. A couple of cores are left free
+    # for the rest of the machine. `--freeze` writes to disjoint test case directories, so it is
+    # safe to run in parallel too.
+    max_workers = max(1, (os.cpu_count() or 1) - 2)
+    test_suite_dir = test_suite_dir.resolve()
+    # Ordering test cases by their expected runtime means the whole suite is discovered up front, which
+    # costs far less than a slow test case being started last.
+    runtimes = load_runtimes(test_suite_dir)
+    tests = sorted(discover(test_suite_dir, exe), key=longest_first(test_suite_dir, runtimes))
+    run = functools.partial(run_one, action_name=action_arg.replace('-', ''), action=action)
+    (attempts, failures, durations) = asyncio.run(run_test_suite(tests, run, max_workers, fail_fast))
+    save_runtimes(test_suite_dir, runtimes, tests, durations)
 
     if failures == 0:
         print("PASS")